@@ -1,11 +1,11 @@
 # app.py
-import os
-import threading
-from typing import Any, Dict, List
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Tuple
 
-import httpx
 from fastapi import FastAPI, Request
-from starlette.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse
+from starlette.responses import HTMLResponse, RedirectResponse, PlainTextResponse
 
 from fastmcp import FastMCP
 from settings import settings
@@ -15,8 +15,10 @@ from nd_oauth import (
     code_challenge_from_verifier,
     build_authorize_url,
     exchange_code_for_tokens,
+    close_token_client,
 )
-from extractors import extract_text_from_bytes
+from extractors import extract_text_from_bytes, get_extraction_pool
+from store import FileStore
 
 
 # =========================
@@ -29,7 +31,7 @@ NetDocuments connector (MCP) exposing two tools:
   Inline params supported: cabinetId:<id> top:<n> orderby:<relevance|lastMod> select:<standardAttributes>
   Example: "cabinetId:NG-ABCD top:50 orderby:lastMod project alpha pdf"
   Remaining words become NetDocuments 'q' string.
-- fetch(id): downloads binary with base64=true, decodes, extracts plaintext (PDF/DOCX/TXT best-effort), returns full text.
+- fetch(id): downloads the raw binary, extracts plaintext (PDF/DOCX/TXT best-effort), returns full text.
 
 Authorize first via /oauth/start. After callback, tokens are saved and tools can call ND.
 """
@@ -37,17 +39,45 @@ Authorize first via /oauth/start. After callback, tokens are saved and tools can
 mcp = FastMCP(name="NetDocuments MCP", instructions=server_instructions)
 nd = NDClient()
 
+# Bound tool concurrency so a bursty MCP client can't saturate ND rate limits
+# or pile up large document buffers in one worker
+_SEARCH_SEM = asyncio.Semaphore(settings.MAX_CONCURRENT_SEARCH)
+_FETCH_SEM = asyncio.Semaphore(settings.MAX_CONCURRENT_FETCH)
+
+
+# Result fields arrive under different names depending on the ND endpoint;
+# probe them in priority order instead of chaining dict.get calls inline
+_ID_KEYS = ("id", "documentId", "docId", "_id")
+_NAME_KEYS = ("name", "title", "filename")
+_EXT_KEYS = ("extension", "fileExtension")
+_SNIPPET_KEYS = ("description", "summary")
+_URL_KEYS = ("url", "href")
+
+
+def _first(d: Dict[str, Any], keys: Tuple[str, ...], default: Any = None) -> Any:
+    # Truthiness (not `is not None`) to match the old `a or b or c` chains
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return v
+    return default
+
+
+# Query tokenizer: double-quoted, single-quoted, or bare whitespace-delimited tokens.
+# Much cheaper than spinning up a shlex state machine per search.
+_TOKEN_RE = re.compile(r'"([^"]*)"|\'([^\']*)\'|(\S+)')
+
 
 def _parse_query_params(q: str) -> Dict[str, Any]:
-    import shlex
-    parts = shlex.split(q or "")
-    params: Dict[str, Any] = {"free": []}
-    for p in parts:
-        if ":" in p:
-            k, v = p.split(":", 1)
+    free: List[str] = []
+    params: Dict[str, Any] = {"free": free}
+    for m in _TOKEN_RE.finditer(q or ""):
+        tok = next(g for g in m.groups() if g is not None)
+        if ":" in tok:
+            k, v = tok.split(":", 1)
             params[k.strip()] = v.strip()
         else:
-            params["free"].append(p)
+            free.append(tok)
     return params
 
 
@@ -59,101 +89,119 @@ async def search(query: str) -> Dict[str, List[Dict[str, Any]]]:
     The remaining free text becomes the 'q' parameter for NetDocuments.
     Returns objects with: id, title, text (snippet), url.
     """
-    p = _parse_query_params(query)
-    cabinet_id = p.get("cabinetId")
-    top = int(p.get("top", settings.SEARCH_DEFAULT_TOP))
-    orderby = p.get("orderby", settings.SEARCH_DEFAULT_ORDER)
-    select = p.get("select", "standardAttributes")
-    free = " ".join(p.get("free", []))
-
-    # If no cabinet, try the first available
-    if not cabinet_id:
+    async with _SEARCH_SEM:
+        p = _parse_query_params(query)
+        cabinet_id = p.get("cabinetId")
+        top = int(p.get("top", settings.SEARCH_DEFAULT_TOP))
+        orderby = p.get("orderby", settings.SEARCH_DEFAULT_ORDER)
+        select = p.get("select", "standardAttributes")
+        free = " ".join(p.get("free", []))
+
+        # If no cabinet, try the first available
+        if not cabinet_id:
+            try:
+                cabs = await nd.get_user_cabinets()
+                if isinstance(cabs, list) and cabs:
+                    cabinet_id = cabs[0].get("id") or cabs[0].get("cabinetId")
+            except Exception:
+                cabinet_id = None  # allow cross-cabinet if supported
+
         try:
-            cabs = await nd.get_user_cabinets()
-            if isinstance(cabs, list) and cabs:
-                cabinet_id = cabs[0].get("id") or cabs[0].get("cabinetId")
-        except Exception:
-            cabinet_id = None  # allow cross-cabinet if supported
-
-    try:
-        resp = await nd.search(free, cabinet_id=cabinet_id, top=top, orderby=orderby, select=select)
-    except Exception as e:
-        return {"results": [], "error": str(e)}
-
-    results = []
-    items = resp if isinstance(resp, list) else resp.get("results") or resp.get("items") or []
-    for i, it in enumerate(items):
-        doc_id = it.get("id") or it.get("documentId") or it.get("docId") or it.get("_id") or str(i)
-        name = it.get("name") or it.get("title") or it.get("filename") or f"Document {i+1}"
-        ext = it.get("extension") or it.get("fileExtension") or ""
-        title = f"{name}{('.' + ext) if ext and not name.lower().endswith('.'+ext.lower()) else ''}"
-        snippet = it.get("description") or it.get("summary") or "No preview available"
-        url = it.get("url") or it.get("href") or ""
-        results.append({"id": str(doc_id), "title": title, "text": snippet, "url": url})
-
-    return {"results": results}
+            resp = await nd.search(free, cabinet_id=cabinet_id, top=top, orderby=orderby, select=select)
+        except Exception as e:
+            return {"results": [], "error": str(e)}
+
+        results = []
+        items = resp if isinstance(resp, list) else resp.get("results") or resp.get("items") or []
+        for i, it in enumerate(items):
+            doc_id = _first(it, _ID_KEYS) or str(i)
+            name = _first(it, _NAME_KEYS) or f"Document {i+1}"
+            ext = _first(it, _EXT_KEYS, "")
+            title = f"{name}{('.' + ext) if ext and not name.lower().endswith('.'+ext.lower()) else ''}"
+            snippet = _first(it, _SNIPPET_KEYS, "No preview available")
+            url = _first(it, _URL_KEYS, "")
+            results.append({"id": str(doc_id), "title": title, "text": snippet, "url": url})
+
+        return {"results": results}
 
 
 @mcp.tool()
 async def fetch(id: str) -> Dict[str, Any]:
     """Retrieve full text for a document by ID. Returns id, title, text, url, metadata."""
-    try:
-        info = await nd.get_document_info(id)
-    except Exception as e:
-        info = {"name": f"Document {id}", "error": str(e)}
-
-    try:
-        data = await nd.download_document_bytes_base64(id)
-    except Exception as e:
-        return {"id": id, "title": info.get("name") or f"Document {id}", "text": "", "url": "", "metadata": {"error": str(e)}}
-
-    filename = info.get("name") or info.get("filename") or f"document-{id}"
-    text, mime = extract_text_from_bytes(filename, data)
-    truncated = False
-    if text and len(text) > settings.MAX_FETCH_CHARS:
-        text = text[: settings.MAX_FETCH_CHARS] + "\n\n[Truncated]"
-        truncated = True
-
-    return {
-        "id": id,
-        "title": filename,
-        "text": text or "",
-        "url": info.get("url") or "",
-        "metadata": {
-            "mime": mime,
-            "truncated": truncated,
-            "cabinetId": info.get("cabinetId"),
-            "repositoryId": info.get("repositoryId"),
-            "extension": info.get("extension"),
-            "size": info.get("size"),
-        },
-    }
-
-
-def _start_internal_mcp():
-    # Run FastMCP SSE server on 127.0.0.1:<INTERNAL_SSE_PORT>
-    mcp.run(transport="sse", host="127.0.0.1", port=settings.INTERNAL_SSE_PORT)
+    async with _FETCH_SEM:
+        # Info and download are independent ND calls; run them concurrently
+        info, data = await asyncio.gather(
+            nd.get_document_info(id),
+            nd.download_document_bytes(id),
+            return_exceptions=True,
+        )
+        if isinstance(info, BaseException):
+            info = {"name": f"Document {id}", "error": str(info)}
+        if isinstance(data, BaseException):
+            return {"id": id, "title": info.get("name") or f"Document {id}", "text": "", "url": "", "metadata": {"error": str(data)}}
+
+        filename = info.get("name") or info.get("filename") or f"document-{id}"
+        # Parse in a worker process: a multi-MB PDF would otherwise block the
+        # event loop for seconds and stall every other request. The worker
+        # truncates to MAX_FETCH_CHARS itself so huge documents never cross
+        # the pickle boundary in full.
+        text, mime, truncated = await asyncio.get_running_loop().run_in_executor(
+            get_extraction_pool(), extract_text_from_bytes, filename, data, settings.MAX_FETCH_CHARS
+        )
+
+        return {
+            "id": id,
+            "title": filename,
+            "text": text or "",
+            "url": info.get("url") or "",
+            "metadata": {
+                "mime": mime,
+                "truncated": truncated,
+                "cabinetId": info.get("cabinetId"),
+                "repositoryId": info.get("repositoryId"),
+                "extension": info.get("extension"),
+                "size": info.get("size"),
+            },
+        }
 
 
 # =========================
 # FastAPI app (public)
 # =========================
 
-app = FastAPI(title="NetDocuments MCP Unified Server")
+# Serve MCP in-process: mounting the FastMCP ASGI app removes the old
+# thread + loopback reverse proxy, so SSE bytes no longer cross an extra
+# HTTP hop and request cancellation propagates directly.
+mcp_app = mcp.http_app(transport="sse", path="/sse/")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The MCP session manager needs its own lifespan to run inside ours
+    async with mcp_app.lifespan(app):
+        yield
+        # Release pooled HTTP connections held by the ND client and token client
+        await nd.aclose()
+        await close_token_client()
 
-# Simple in-memory state for PKCE
-_state = None
-_verifier = None
 
+app = FastAPI(title="NetDocuments MCP Unified Server", lifespan=lifespan)
 
-@app.on_event("startup")
-async def startup_event():
-    # Avoid double-start when using --reload
-    if getattr(app.state, "mcp_started", False):
-        return
-    app.state.mcp_started = True
-    t = threading.Thread(target=_start_internal_mcp, daemon=True)
-    t.start()
+# PKCE state goes through the shared store so the callback still works when
+# it lands on a different uvicorn worker than the one that started the flow
+_store = FileStore()
+_OAUTH_STATE_TTL = 600  # seconds a pending authorization stays valid
+
+
+@app.middleware("http")
+async def sse_headers(request: Request, call_next):
+    # Keep the anti-buffering headers the old proxy set, now that the SSE
+    # responses come straight from the mounted MCP app
+    response = await call_next(request)
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        response.headers.setdefault("Cache-Control", "no-cache")
+        response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 
 @app.get("/healthz")
@@ -177,23 +225,24 @@ async def root():
 @app.get("/oauth/start")
 async def oauth_start():
     import secrets
-    global _state, _verifier
-    _state = secrets.token_urlsafe(16)
-    _verifier = generate_code_verifier()
-    challenge = code_challenge_from_verifier(_verifier)
-    url = build_authorize_url(_state, challenge)
+    state = secrets.token_urlsafe(16)
+    verifier = generate_code_verifier()
+    challenge = code_challenge_from_verifier(verifier)
+    _store.set(f"oauth:state:{state}", verifier, ttl=_OAUTH_STATE_TTL)
+    url = build_authorize_url(state, challenge)
     return RedirectResponse(url)
 
 
 @app.get("/oauth/callback")
 async def oauth_callback(request: Request, code: str | None = None, state: str | None = None):
-    if state != _state:
+    verifier = _store.pop(f"oauth:state:{state}") if state else None
+    if verifier is None:
         return PlainTextResponse("State mismatch", status_code=400)
     if not code:
         return PlainTextResponse("Missing code", status_code=400)
 
     # If your tenant enforces PKCE verification during token exchange, add code_verifier parameter:
-    # tok = await exchange_code_for_tokens(code, _verifier)
+    # tok = await exchange_code_for_tokens(code, verifier)
     tok = await exchange_code_for_tokens(code)  # works for many tenants; switch to the line above if needed
 
     return HTMLResponse(
@@ -205,31 +254,9 @@ async def oauth_callback(request: Request, code: str | None = None, state: str |
     )
 
 
-# ----- SSE proxy to internal FastMCP server -----
+# ----- MCP (SSE + message endpoints), mounted last so the routes above win -----
 
-@app.get("/sse/")
-async def sse_proxy(request: Request):
-    """
-    Reverse-proxy the Server-Sent Events endpoint from the internal FastMCP server
-    so that both OAuth and MCP live under one public origin.
-    """
-    target = f"http://127.0.0.1:{settings.INTERNAL_SSE_PORT}/sse/"
-    headers = {
-        # Preserve typical SSE headers
-        "accept": request.headers.get("accept", "text/event-stream"),
-        "cache-control": "no-cache",
-        "connection": "keep-alive",
-    }
-
-    async def event_stream():
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("GET", target, headers=headers, params=dict(request.query_params)) as r:
-                r.raise_for_status()
-                async for chunk in r.aiter_raw():
-                    # Pass through exact bytes from the SSE origin
-                    yield chunk
-
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+app.mount("/", mcp_app)
 
 
 # Entry point (local dev)
@@ -1,33 +1,107 @@
-import io, zipfile
-from typing import Tuple
+import io, os, zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
 from settings import settings
 
+# Shared pool so CPU-bound parsing (PyPDF especially) runs off the event loop
+# and in parallel across cores. Created lazily so importing this module in a
+# worker process doesn't recursively spawn pools.
+_EXTRACTION_POOL: Optional[ProcessPoolExecutor] = None
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    global _EXTRACTION_POOL
+    if _EXTRACTION_POOL is None:
+        _EXTRACTION_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _EXTRACTION_POOL
+
 def _is_pdf(data: bytes) -> bool:
     return data.startswith(b"%PDF")
 
-def _is_docx(data: bytes) -> bool:
-    # DOCX is a zip; this quick check tries to open as zip and look for document.xml
-    try:
-        with zipfile.ZipFile(io.BytesIO(data)) as z:
-            return any(n.endswith("word/document.xml") for n in z.namelist())
-    except Exception:
-        return False
+_DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+def _extract_docx_text(zf: zipfile.ZipFile, max_chars: int = 0) -> str:
+    """
+    Pull text straight out of word/document.xml in an already-open DOCX zip.
+    iterparse collects <w:t> runs and newlines on paragraph ends, clearing
+    elements as it goes, instead of building python-docx's full object model.
+    max_chars > 0 stops the parse once that much text is collected.
+    """
+    from xml.etree.ElementTree import iterparse
+
+    chunks = []
+    total = 0
+    with zf.open("word/document.xml") as f:
+        for _, elem in iterparse(f):
+            tag = elem.tag
+            if tag == _DOCX_NS + "t":
+                if elem.text:
+                    chunks.append(elem.text)
+                    total += len(elem.text)
+            elif tag == _DOCX_NS + "p":
+                chunks.append("\n")
+                total += 1
+                elem.clear()
+                if max_chars and total > max_chars:
+                    break
+    return "".join(chunks)
 
 def _try_decode_text(data: bytes) -> str:
-    for enc in ("utf-8", "utf-16", "latin-1"):
-        try:
-            return data.decode(enc)
-        except Exception:
-            continue
+    # UTF-8 dominates in practice; a strict decode is one C-level pass and
+    # skips the detector entirely in the common case
+    try:
+        return data.decode("utf-8")
+    except Exception:
+        pass
+    # Single-pass detection instead of decoding the whole buffer per candidate
+    try:
+        from charset_normalizer import from_bytes
+        best = from_bytes(data).best()
+        if best is not None:
+            return str(best)
+    except Exception:
+        pass
     # fallback replace
     return data.decode("utf-8", errors="replace")
 
-def _extract_pdf_text(data: bytes) -> str:
+def _extract_pdf_text(data: bytes, max_chars: int = 0) -> str:
     """
-    Extract text from a PDF using PyPDF.
+    Extract text from a PDF using PDFium (C++), falling back to PyPDF.
     Assumes text layer exists (as ND OCR writes it back).
     Returns empty string if no text layer is present.
+    max_chars > 0 stops reading pages once that much text is collected.
     """
+    try:
+        return _extract_pdf_text_pdfium(data, max_chars)
+    except Exception:
+        # PDFium unavailable or choked on this file; PyPDF is slower but
+        # tolerates more malformed input
+        return _extract_pdf_text_pypdf(data, max_chars)
+
+def _extract_pdf_text_pdfium(data: bytes, max_chars: int = 0) -> str:
+    import pypdfium2 as pdfium
+
+    # Empty password handles owner-password-only PDFs; ignored when unencrypted
+    pdf = pdfium.PdfDocument(data, password="")
+    try:
+        chunks = []
+        total = 0
+        for page in pdf:
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
+            chunks.append(text)
+            total += len(text) + 1
+            # Strictly greater, so the caller still sees the overflow and
+            # marks the result as truncated
+            if max_chars and total > max_chars:
+                break
+        return "\n".join(chunks).strip()
+    finally:
+        pdf.close()
+
+def _extract_pdf_text_pypdf(data: bytes, max_chars: int = 0) -> str:
     from pypdf import PdfReader
 
     try:
@@ -46,17 +120,37 @@ def _extract_pdf_text(data: bytes) -> str:
             return ""
 
     chunks = []
+    total = 0
     for page in getattr(reader, "pages", []) or []:
         try:
             text = page.extract_text() or ""
         except Exception:
             text = ""
         chunks.append(text)
+        total += len(text) + 1
+        if max_chars and total > max_chars:
+            break
 
     return "\n".join(chunks).strip()
 
-def extract_text_from_bytes(filename: str, data: bytes) -> Tuple[str, str]:
-    """Return (text, mimetype_guess) from document bytes."""
+TRUNCATION_NOTICE = "\n\n[Truncated]"
+
+def extract_text_from_bytes(filename: str, data: bytes, max_chars: int = 0) -> Tuple[str, str, bool]:
+    """Return (text, mimetype_guess, truncated) from document bytes.
+
+    max_chars > 0 bounds the extracted text: PDF and DOCX parsing stop early
+    once the budget is met, the result is sliced here in the worker (so only
+    the bounded text crosses the pickle boundary), and the notice is appended
+    before returning.
+    """
+    text, mime = _extract(filename, data, max_chars)
+    truncated = False
+    if max_chars and text and len(text) > max_chars:
+        text = text[:max_chars] + TRUNCATION_NOTICE
+        truncated = True
+    return text, mime, truncated
+
+def _extract(filename: str, data: bytes, max_chars: int = 0) -> Tuple[str, str]:
     name = (filename or "").lower()
 
     # Plain-text quick path
@@ -65,18 +159,26 @@ def extract_text_from_bytes(filename: str, data: bytes) -> Tuple[str, str]:
 
     # PDF → PyPDF
     if name.endswith(".pdf") or _is_pdf(data):
-        pdf_text = _extract_pdf_text(data)
+        pdf_text = _extract_pdf_text(data, max_chars)
         return pdf_text, "application/pdf"
 
-    # DOCX
-    if settings.ENABLE_DOCX and (name.endswith(".docx") or _is_docx(data)):
+    # DOCX is a zip container: open the ZipFile once and reuse it for both the
+    # document.xml probe and extraction. Bytes without the zip magic can't be
+    # DOCX, so they skip the probe entirely.
+    if settings.ENABLE_DOCX and (name.endswith(".docx") or data[:2] == b"PK"):
         try:
-            import docx  # python-docx
-            doc = docx.Document(io.BytesIO(data))
-            paragraphs = [p.text for p in doc.paragraphs]
-            return "\n".join(paragraphs), "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+            zf = zipfile.ZipFile(io.BytesIO(data))
         except Exception:
-            return "", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+            zf = None
+        if zf is not None:
+            with zf:
+                if name.endswith(".docx") or any(n.endswith("word/document.xml") for n in zf.namelist()):
+                    try:
+                        return _extract_docx_text(zf, max_chars), _DOCX_MIME
+                    except Exception:
+                        return "", _DOCX_MIME
+        elif name.endswith(".docx"):
+            return "", _DOCX_MIME
 
     # Unknown → best-effort text
     return _try_decode_text(data), "application/octet-stream"
@@ -1,14 +1,62 @@
 from typing import Any, Dict, List, Optional, Tuple
-import base64, io, json
+import asyncio
+import base64
+import binascii
+import hashlib
 import httpx
+from cachetools import TTLCache
 from settings import settings
-from nd_oauth import get_access_token, refresh_access_token_if_needed
+from nd_oauth import get_access_token, access_token_expired, refresh_access_token_if_needed
+
+# orjson parses straight from bytes and is ~3x faster than stdlib json on the
+# tens-of-KB search payloads; fall back quietly when it isn't installed
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+_B64_ALPHABET = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\r\n")
+
+def _looks_base64(data: bytes) -> bool:
+    head = data[:64]
+    return bool(head) and all(c in _B64_ALPHABET for c in head)
 
 class NDClient:
     def __init__(self):
         self.api = settings.ND_API_BASE.rstrip('/')
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_lock = asyncio.Lock()
+        # Document metadata and cabinet lists are effectively static on the
+        # scale of a chat session; short TTLs keep repeat fetches off the wire
+        self._info_cache: TTLCache = TTLCache(maxsize=4096, ttl=300)
+        self._cabinets_cache: TTLCache = TTLCache(maxsize=8, ttl=600)
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        # Lazily create a shared client so the connection pool (and its event loop
+        # binding) is reused across requests instead of paying TCP+TLS per call.
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.AsyncClient(
+                        base_url=self.api,
+                        timeout=60,
+                        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                        http2=True,
+                    )
+        return self._client
+
+    async def aclose(self):
+        """Close the shared HTTP client (wired to FastAPI shutdown)."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def _authed(self) -> Dict[str, str]:
+        if access_token_expired():
+            # Refresh ahead of time instead of burning a round-trip on a 401
+            await refresh_access_token_if_needed()
         tok = get_access_token()
         if not tok:
             raise RuntimeError("Not authorized with NetDocuments yet. Visit /oauth/start to authorize.")
@@ -17,20 +65,30 @@ class NDClient:
     async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
         headers = kwargs.pop("headers", {})
         headers.update(await self._authed())
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.request(method, f"{self.api}{path}", headers=headers, **kwargs)
-            if resp.status_code == 401:
-                # try a single refresh then retry once
-                fresh = await refresh_access_token_if_needed()
-                if fresh:
-                    headers.update({"Authorization": f"Bearer {fresh}"})
-                    resp = await client.request(method, f"{self.api}{path}", headers=headers, **kwargs)
-            resp.raise_for_status()
-            return resp
+        client = await self._get_client()
+        resp = await client.request(method, path, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            # try a single refresh then retry once; drop cached responses that
+            # may reflect the old token's permissions
+            fresh = await refresh_access_token_if_needed()
+            if fresh:
+                self._info_cache.clear()
+                self._cabinets_cache.clear()
+                headers.update({"Authorization": f"Bearer {fresh}"})
+                resp = await client.request(method, path, headers=headers, **kwargs)
+        resp.raise_for_status()
+        return resp
 
     async def get_user_cabinets(self) -> List[Dict[str, Any]]:
+        # Keyed on the access token so a re-auth as a different user misses
+        key = hashlib.sha256((get_access_token() or "").encode()).hexdigest()
+        cached = self._cabinets_cache.get(key)
+        if cached is not None:
+            return cached
         resp = await self._request("GET", "/User/cabinets")
-        return resp.json()
+        cabinets = _loads(resp.content)
+        self._cabinets_cache[key] = cabinets
+        return cabinets
 
     async def search(self, q: str, cabinet_id: Optional[str] = None, top: int = 50, orderby: str = "relevance", select: str = "standardAttributes", skiptoken: Optional[str] = None) -> Dict[str, Any]:
         params = {"$top": str(top), "$orderby": f"{orderby} desc", "$select": select}
@@ -42,15 +100,32 @@ class NDClient:
             path = "/Search"
         params["q"] = q
         resp = await self._request("GET", path, params=params)
-        return resp.json()
+        return _loads(resp.content)
 
     async def get_document_info(self, doc_id: str) -> Dict[str, Any]:
+        cached = self._info_cache.get(doc_id)
+        if cached is not None:
+            return cached
         resp = await self._request("GET", f"/Document/{doc_id}/info")
-        return resp.json()
-
-    async def download_document_bytes_base64(self, doc_id: str) -> bytes:
-        # Add base64=true to ensure base64-encoded response body (then decode)
-        resp = await self._request("GET", f"/Document/{doc_id}", params={"base64":"true"})
-        # Some ND implementations return raw bytes; with base64=true we expect base64 text
-        b64txt = resp.text
-        return base64.b64decode(b64txt)
+        info = _loads(resp.content)
+        self._info_cache[doc_id] = info
+        return info
+
+    async def download_document_bytes(self, doc_id: str) -> bytes:
+        # Request the raw binary body; base64=true inflated the wire payload by
+        # ~33% and forced a full str + b64decode pass over every download
+        resp = await self._request("GET", f"/Document/{doc_id}")
+        data = resp.content
+        # Known binary magics up front mean we can skip the sniff entirely
+        if data[:4] == b"%PDF" or data[:2] == b"PK":
+            return data
+        # Some tenants answer base64 regardless of what we ask for. Strip MIME
+        # line wrapping first — validate=True rejects newlines — then decode
+        # straight from bytes so the body is never materialized as a str
+        # (which the old resp.text path did, at ~2.3x the file size peak).
+        if _looks_base64(data):
+            try:
+                return base64.b64decode(data.translate(None, b"\r\n"), validate=True)
+            except (binascii.Error, ValueError):
+                pass
+        return data
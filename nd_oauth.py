@@ -1,37 +1,118 @@
-import base64, hashlib, os, time
+import asyncio
+import base64, hashlib, json, logging, os, time
 from typing import Dict, Optional
 import httpx
 from settings import settings
+from store import FileStore
 
-# Very simple in-memory token store for MVP; replace with persistent storage as needed.
+# Tokens live in the shared FileStore so every uvicorn worker sees the same
+# credentials; _TOKENS is this process's cached copy. tokens.json is only
+# read once to migrate older deployments.
 TOKENS_PATH = "tokens.json"
+_TOKENS_KEY = "nd:tokens"
+_STORE = FileStore()
 _TOKENS: Dict[str, str] = {}
+_LOADED = False
 
-def _load_tokens():
-    global _TOKENS
+# Client credentials are immutable, so the Basic auth header for the token
+# endpoint can be built once at import
+_BASIC_AUTH = "Basic " + base64.b64encode(
+    f"{settings.ND_CLIENT_ID}:{settings.ND_CLIENT_SECRET}".encode()
+).decode()
+_TOKEN_HEADERS = {
+    "Authorization": _BASIC_AUTH,
+    "Content-Type": "application/x-www-form-urlencoded",
+}
+
+# Shared client for the token endpoint so exchanges/refreshes reuse connections.
+_TOKEN_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _token_client() -> httpx.AsyncClient:
+    global _TOKEN_CLIENT
+    if _TOKEN_CLIENT is None:
+        _TOKEN_CLIENT = httpx.AsyncClient(timeout=30)
+    return _TOKEN_CLIENT
+
+async def close_token_client():
+    """Close the shared token-endpoint client (wired to FastAPI shutdown)."""
+    global _TOKEN_CLIENT
+    if _TOKEN_CLIENT is not None:
+        await _TOKEN_CLIENT.aclose()
+        _TOKEN_CLIENT = None
+
+def _load_tokens(force: bool = False):
+    # Read the store once per process; afterwards the in-memory dict answers
+    # every API call. force=True re-reads to pick up another worker's refresh.
+    global _TOKENS, _LOADED
+    if _LOADED and not force:
+        return
+    tokens = _STORE.get(_TOKENS_KEY)
+    if tokens is None:
+        # Migrate tokens.json written by older deployments
+        try:
+            if os.path.exists(TOKENS_PATH):
+                with open(TOKENS_PATH, "r") as f:
+                    tokens = json.load(f)
+        except Exception:
+            tokens = None
+    _TOKENS = tokens or {}
+    _LOADED = True
+
+def _save_tokens(payload: Dict[str, str]):
+    _STORE.set(_TOKENS_KEY, payload)
+
+# Strong references to in-flight save tasks: the loop only keeps weak refs,
+# so an unreferenced task could be garbage-collected before it runs
+_SAVE_TASKS: set = set()
+
+def _on_save_done(task: "asyncio.Task"):
+    _SAVE_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.getLogger(__name__).warning("Failed to persist tokens: %s", task.exception())
+
+def _save_tokens_soon():
+    # Persist off the event loop when one is running; fall back to a direct
+    # write from sync contexts (e.g. scripts/tests). Snapshot the payload
+    # now — _TOKENS may be rebound or mutated before the write runs.
+    payload = dict(_TOKENS)
     try:
-        import json, os
-        if os.path.exists(TOKENS_PATH):
-            with open(TOKENS_PATH, "r") as f:
-                _TOKENS = json.load(f)
-        else:
-            _TOKENS = {}
-    except Exception:
-        _TOKENS = {}
-
-def _save_tokens():
-    import json
-    with open(TOKENS_PATH, "w") as f:
-        json.dump(_TOKENS, f, indent=2)
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(_save_tokens, payload))
+    except RuntimeError:
+        _save_tokens(payload)
+        return
+    _SAVE_TASKS.add(task)
+    task.add_done_callback(_on_save_done)
 
 def get_access_token() -> Optional[str]:
     """Return the current access token if present (MVP: single-user)."""
     _load_tokens()
-    return _TOKENS.get("access_token")
+    tok = _TOKENS.get("access_token")
+    if not tok:
+        # This worker may have cached an empty store before the user finished
+        # authorizing on another worker; re-read before reporting unauthorized
+        _load_tokens(force=True)
+        tok = _TOKENS.get("access_token")
+    return tok
+
+def access_token_expired(skew: int = 30) -> bool:
+    """True when the stored access token expires within `skew` seconds.
+
+    Unknown expiry (tenant didn't return expires_in) counts as not expired;
+    the 401-retry path in NDClient covers that case.
+    """
+    _load_tokens()
+    expires_at = _TOKENS.get("expires_at")
+    if not expires_at:
+        return False
+    return time.time() + skew >= expires_at
 
 def get_refresh_token() -> Optional[str]:
     _load_tokens()
-    return _TOKENS.get("refresh_token")
+    tok = _TOKENS.get("refresh_token")
+    if not tok:
+        _load_tokens(force=True)
+        tok = _TOKENS.get("refresh_token")
+    return tok
 
 def set_tokens(access_token: str, refresh_token: Optional[str] = None, expires_in: Optional[int] = None):
     _load_tokens()
@@ -40,7 +121,7 @@ def set_tokens(access_token: str, refresh_token: Optional[str] = None, expires_i
         _TOKENS["refresh_token"] = refresh_token
     if expires_in:
         _TOKENS["expires_at"] = int(time.time()) + int(expires_in)
-    _save_tokens()
+    _save_tokens_soon()
 
 # ===== PKCE helpers =====
 def generate_code_verifier() -> str:
@@ -70,30 +151,49 @@ async def exchange_code_for_tokens(code: str) -> Dict:
         "redirect_uri": settings.ND_REDIRECT_URI,
     }
     # ND allows Basic auth with client_id:client_secret for code exchange
-    basic = base64.b64encode(f"{settings.ND_CLIENT_ID}:{settings.ND_CLIENT_SECRET}".encode()).decode()
-    headers = {"Authorization": f"Basic {basic}", "Content-Type": "application/x-www-form-urlencoded"}
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(settings.ND_AUTH_TOKEN_URL, data=data, headers=headers)
-        resp.raise_for_status()
-        tok = resp.json()
+    resp = await _token_client().post(settings.ND_AUTH_TOKEN_URL, data=data, headers=_TOKEN_HEADERS)
+    resp.raise_for_status()
+    tok = resp.json()
     set_tokens(tok.get("access_token"), tok.get("refresh_token"), tok.get("expires_in"))
     return tok
 
+# Serializes refreshes so N concurrent expired requests trigger one round-trip
+_REFRESH_LOCK = asyncio.Lock()
+
 async def refresh_access_token_if_needed() -> Optional[str]:
     """Refresh on 401 or when expired (lazy). Returns fresh access token or None."""
+    global _TOKENS
     refresh = get_refresh_token()
     if not refresh:
         return None
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh,
-    }
-    # refresh uses Basic auth header like auth code exchange
-    basic = base64.b64encode(f"{settings.ND_CLIENT_ID}:{settings.ND_CLIENT_SECRET}".encode()).decode()
-    headers = {"Authorization": f"Basic {basic}", "Content-Type": "application/x-www-form-urlencoded"}
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(settings.ND_AUTH_TOKEN_URL, data=data, headers=headers)
+    stale = get_access_token()
+    async with _REFRESH_LOCK:
+        # Another request may have refreshed while we waited on the lock.
+        # Trust in-process state first: the store write can lag memory, and a
+        # blind store reload here would clobber a fresher in-memory token.
+        current = _TOKENS.get("access_token")
+        if current and current != stale:
+            return current
+        # Another worker may have refreshed via the shared store; adopt its
+        # copy only when it is genuinely newer than what we hold
+        stored = _STORE.get(_TOKENS_KEY) or {}
+        if (
+            stored.get("access_token")
+            and stored["access_token"] != stale
+            and stored.get("expires_at", 0) > _TOKENS.get("expires_at", 0)
+        ):
+            _TOKENS = stored
+            return stored["access_token"]
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh,
+        }
+        # refresh uses Basic auth header like auth code exchange
+        resp = await _token_client().post(settings.ND_AUTH_TOKEN_URL, data=data, headers=_TOKEN_HEADERS)
         resp.raise_for_status()
         tok = resp.json()
-    set_tokens(tok.get("access_token"), tok.get("refresh_token"), tok.get("expires_in"))
-    return tok.get("access_token")
+        set_tokens(tok.get("access_token"), tok.get("refresh_token"), tok.get("expires_in"))
+        # Persist before releasing the lock: with refresh-token rotation,
+        # another worker refreshing against the old token would kill the grant
+        _save_tokens(dict(_TOKENS))
+        return tok.get("access_token")
@@ -95,18 +95,13 @@ async def fetch(id: str) -> Dict[str, Any]:
         info = {"name": f"Document {id}", "error": str(e)}
 
     try:
-        data = await nd.download_document_bytes_base64(id)
+        data = await nd.download_document_bytes(id)
     except Exception as e:
         return {"id": id, "title": info.get("name") or f"Document {id}", "text": "", "url": "", "metadata": {"error": str(e)}}
 
     filename = info.get("name") or info.get("filename") or f"document-{id}"
     logger.info(f'File located: {filename}')
-    text, mime = extract_text_from_bytes(filename, data)
-    if text and len(text) > settings.MAX_FETCH_CHARS:
-        text = text[: settings.MAX_FETCH_CHARS] + "\n\n[Truncated]"
-        truncated = True
-    else:
-        truncated = False
+    text, mime, truncated = extract_text_from_bytes(filename, data, settings.MAX_FETCH_CHARS)
 
     result = {
         "id": id,
@@ -17,14 +17,13 @@ class Settings(BaseSettings):
     SERVER_HOST: str = Field("0.0.0.0")
     SERVER_PORT: int = Field(8000)
 
-    # Internal SSE port for FastMCP
-    INTERNAL_SSE_PORT: int = Field(9000)
-
     # Behavior
     SEARCH_DEFAULT_TOP: int = Field(50)
     SEARCH_DEFAULT_ORDER: str = Field("relevance")  # or 'lastMod'
     MAX_FETCH_CHARS: int = Field(150_000)
     ENABLE_DOCX: bool = Field(True)
+    MAX_CONCURRENT_SEARCH: int = Field(16)
+    MAX_CONCURRENT_FETCH: int = Field(8)
 
     # pydantic-settings v2 style config
     model_config = SettingsConfigDict(
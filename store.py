@@ -0,0 +1,75 @@
+# store.py
+# Tiny persistent key-value store shared across uvicorn workers.
+#
+# Workers are separate processes, so module globals (PKCE state, tokens) set
+# in one worker are invisible to the callback or API call landing on another.
+# This keeps small JSON-serializable values in one file guarded by
+# fcntl.flock so every worker sees the same data. Entries may carry a TTL.
+# Swap for Redis if the deployment ever spans multiple hosts.
+import fcntl
+import json
+import time
+from typing import Any, Dict, Optional
+
+STORE_PATH = "state.json"
+
+
+class FileStore:
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+
+    def _open(self):
+        # a+ creates the file if missing without truncating existing contents;
+        # the lock is released when the file is closed
+        f = open(self.path, "a+")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    @staticmethod
+    def _load(f) -> Dict[str, Any]:
+        f.seek(0)
+        raw = f.read()
+        if not raw:
+            return {}
+        try:
+            return json.loads(raw)
+        except Exception:
+            return {}
+
+    @staticmethod
+    def _dump(f, data: Dict[str, Any]):
+        f.seek(0)
+        f.truncate()
+        json.dump(data, f, indent=2)
+        f.flush()
+
+    @staticmethod
+    def _live(entry: Optional[Dict[str, Any]]) -> bool:
+        if entry is None:
+            return False
+        expires_at = entry.get("expires_at")
+        return not expires_at or time.time() < expires_at
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._open() as f:
+            entry = self._load(f).get(key)
+        return entry["value"] if self._live(entry) else default
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        with self._open() as f:
+            data = self._load(f)
+            entry: Dict[str, Any] = {"value": value}
+            if ttl:
+                entry["expires_at"] = time.time() + ttl
+            data[key] = entry
+            # opportunistically drop expired entries while we hold the lock
+            data = {k: v for k, v in data.items() if self._live(v)}
+            self._dump(f, data)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self._open() as f:
+            data = self._load(f)
+            entry = data.pop(key, None)
+            if entry is not None:
+                self._dump(f, data)
+        return entry["value"] if self._live(entry) else default